@@ -4,6 +4,65 @@ import torch
 from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence
 from sklearn.impute import SimpleImputer
+from sklearn.preprocessing import OneHotEncoder
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _seq_core(gas, cnd, hrs, n0, n1, n2):
+    """
+    Builds the (length, 4) float32 rate array for a single sample.
+    Compiled with numba when available, replaced by the vectorized
+    NumPy fallback below otherwise.
+    """
+    out = np.zeros((hrs.shape[0] + 1, 4), dtype=np.float32)
+    k, rest = 1, 0
+    for j in range(hrs.shape[0]):
+        h = hrs[j]
+        if h == 0:
+            rest += 1
+        else:
+            hrs_norm = h / n2
+            out[k, 0] = gas[j] / n0 / hrs_norm
+            out[k, 1] = cnd[j] / n1 / hrs_norm
+            out[k, 2] = hrs_norm
+            out[k, 3] = rest
+            rest = 0
+            k += 1
+    return out[:k]
+
+
+def _seq_core_numpy(gas, cnd, hrs, n0, n1, n2):
+    """
+    Vectorized equivalent of _seq_core for installations without numba.
+    """
+    # active months keep their production rates, with a leading zero vector
+    mask = hrs != 0
+    active = np.flatnonzero(mask)
+    out = np.zeros((len(active) + 1, 4), dtype=np.float32)
+
+    # resting (zero hour) months since the previous active month, computed
+    # branchlessly as the gap to the preceding active index
+    idx = np.arange(hrs.shape[0])
+    last_active = np.maximum.accumulate(np.where(mask, idx, -1))
+    prev_active = np.concatenate(([-1], last_active[:-1]))
+
+    hrs_norm = hrs[active] / n2
+    out[1:, 0] = gas[active] / n0 / hrs_norm
+    out[1:, 1] = cnd[active] / n1 / hrs_norm
+    out[1:, 2] = hrs_norm
+    out[1:, 3] = (idx - prev_active - 1)[active]
+
+    return out
+
+
+if numba is not None:
+    _seq_core = numba.njit(cache=True)(_seq_core)
+else:
+    _seq_core = _seq_core_numpy
 
 
 def seq_tensor(gas, cnd, hrs, n=(1e5, 1e4, 1e3)):
@@ -17,23 +76,14 @@ def seq_tensor(gas, cnd, hrs, n=(1e5, 1e4, 1e3)):
     n: tuple
         consists of normalizing factor for each sequence
     """
-    if np.isnan(hrs[0]):
-        return torch.zeros(1, 4)
+    gas = np.asarray(gas, dtype=np.float32)
+    cnd = np.asarray(cnd, dtype=np.float32)
+    hrs = np.asarray(hrs, dtype=np.float32)
 
-    rest, sequences = 0, [[0, 0, 0, 0]]
-    for j, h in enumerate(hrs):
-        if h == 0:
-            rest += 1
-        else:
-            gas_norm, cnd_norm, hrs_norm = gas[j]/n[0], cnd[j]/n[1], hrs[j]/n[2]
-            rates = [gas_norm/hrs_norm, cnd_norm/hrs_norm, hrs_norm, rest]
-            sequences.append(rates)
-            rest = 0
-
-    if not sequences:
+    if np.isnan(hrs[0]):
         return torch.zeros(1, 4)
 
-    return torch.tensor(sequences)
+    return torch.from_numpy(_seq_core(gas, cnd, hrs, n[0], n[1], n[2]))
 
 
 def seq_collate(batch):
@@ -55,15 +105,57 @@ def seq_collate(batch):
     targets = [sample['target'] for sample in batch]
 
     lengths = [len(s) for s in sequences]
-    padded_sequences = pad_sequence(sequences, batch_first=True).contiguous()
+    padded_sequences = pad_sequence(sequences, batch_first=True)
     packed_sequences = pack_padded_sequence(padded_sequences, lengths, batch_first=True, enforce_sorted=False)
-    padded_batch = {'features': torch.stack(features).contiguous(),
+    padded_batch = {'features': torch.stack(features),
                     'sequences': packed_sequences,
-                    'target': torch.stack(targets).contiguous()}
+                    'target': torch.stack(targets)}
 
     return padded_batch
 
 
+class BucketBatchSampler:
+    """
+    Batch sampler that groups samples of similar sequence length, so the
+    padded batches handed to pack_padded_sequence stay dense and the
+    recurrent model processes fewer padded steps.
+    Parameters
+    ----------
+    lengths: array_like
+        sequence length of each sample
+    batch_size: int
+    bucket_bins: int (optional)
+        number of length-quantile buckets
+    shuffle: bool (optional)
+        shuffles samples within buckets and the batch order if true
+    """
+    def __init__(self, lengths, batch_size, bucket_bins=8, shuffle=True):
+        lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+        edges = np.quantile(lengths, np.linspace(0, 1, bucket_bins + 1)[1:-1])
+        bucket_ids = np.digitize(lengths, edges)
+        self.buckets = [np.flatnonzero(bucket_ids == b) for b in np.unique(bucket_ids)]
+        self.num_batches = sum(-(-len(b) // batch_size) for b in self.buckets)
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = np.random.permutation(bucket)
+            batches.extend(bucket[i:i + self.batch_size]
+                           for i in range(0, len(bucket), self.batch_size))
+
+        if self.shuffle:
+            np.random.shuffle(batches)
+        for batch in batches:
+            yield batch.tolist()
+
+
 def preprocess(dataset, normalize_dict, remove_feats=None, augment=False):
     """
     Preprocesses datasets via normalizing and removing unnecessary features.
@@ -79,6 +171,9 @@ def preprocess(dataset, normalize_dict, remove_feats=None, augment=False):
     -------
     feature_dataset: WellDataset
     sequence_dataset: WellDataset
+    encoder: sklearn.preprocessing.OneHotEncoder or None
+        fitted encoder for the string features, reused by exam_loader
+        to keep the exam columns aligned with training
     """
     if remove_feats is not None:
         dataset = dataset.drop(remove_feats, axis=1)
@@ -96,19 +191,28 @@ def preprocess(dataset, normalize_dict, remove_feats=None, augment=False):
     if value_feats:
         num_imputer = SimpleImputer(strategy='mean')
         dataset[value_feats] = num_imputer.fit_transform(dataset[value_feats])
+    encoder = None
     if string_feats:
         cat_imputer = SimpleImputer(strategy='most_frequent')
         dataset[string_feats] = cat_imputer.fit_transform(dataset[string_feats])
-        dataset = pd.get_dummies(dataset, columns=string_feats)
+        encoder = OneHotEncoder(sparse_output=False, dtype=np.float32, handle_unknown='ignore')
+        dummies = encoder.fit_transform(dataset[string_feats])
+        dataset = dataset.drop(string_feats, axis=1)
+        dataset[list(encoder.get_feature_names_out(string_feats))] = dummies
 
-    # normalize data
-    for feats in value_feats:
-        dataset[feats] /= float(normalize_dict[feats])
+    # normalize data with a single vectorized divide over the value columns
+    if value_feats:
+        scales = np.array([float(normalize_dict[f]) for f in value_feats], dtype=np.float32)
+        dataset[value_feats] = dataset[value_feats].to_numpy(dtype=np.float32) / scales
+
+    # store everything numeric as float32 so samples need no cast downstream
+    float_cols = dataset.select_dtypes(include='float64').columns
+    dataset[float_cols] = dataset[float_cols].astype(np.float32)
 
     # split into data w/ or w/o sequence data
     target_name = 'Last 6 mo. Avg. GAS (Mcf)'
     feature_dataset = dataset
-    sequence_dataset = dataset.dropna(subset=[target_name]).reset_index(drop=True)
+    sequence_dataset = dataset.dropna(subset=[target_name])
 
     # data augmentation / inplace addition of data
     if augment:
@@ -118,30 +222,29 @@ def preprocess(dataset, normalize_dict, remove_feats=None, augment=False):
     sequence_dataset = WellDataset(sequence_dataset, total_features, sequence=True)
     feature_dataset = WellDataset(feature_dataset, total_features, sequence=False)
 
-    return feature_dataset, sequence_dataset
+    return feature_dataset, sequence_dataset, encoder
 
 
-def exam_loader(train_data, exam_data, norm_dict, remove_feats=None):
+def exam_loader(exam_data, norm_dict, remove_feats=None, encoder=None):
     """
     Preprocesses exam datasets via normalizing and removing unnecessary features.
     Also one-hot-encodes string features.
     Parameters
     ----------
-    train_data: pandas.DataFrame
-        This is required in order to align the dummy values.
     exam_data: pandas.DataFrame
     norm_dict: dict
     remove_feats: (optional) list
+    encoder: (optional) sklearn.preprocessing.OneHotEncoder
+        encoder fitted by preprocess, required in order to align
+        the dummy columns with the training data.
     Returns
     -------
     exam_dataset: WellDataset
     """
     if remove_feats is not None:
-        train_data = train_data.drop(remove_feats, axis=1)
         exam_data = exam_data.drop(remove_feats, axis=1)
 
-    train_index = train_data.index
-    dataset = pd.concat([train_data, exam_data]).reset_index(drop=True)
+    dataset = exam_data
 
     # remove decision related features
     decision_feats = [col for col in dataset.columns if '$' in col]
@@ -163,19 +266,26 @@ def exam_loader(train_data, exam_data, norm_dict, remove_feats=None):
     if string_feats:
         cat_imputer = SimpleImputer(strategy='most_frequent')
         dataset[string_feats] = cat_imputer.fit_transform(dataset[string_feats])
-        dataset = pd.get_dummies(dataset, columns=string_feats)
 
-    # normalize data
-    for feats in value_feats:
-        dataset[feats] /= float(norm_dict[feats])
+        # the encoder fitted on the train data keeps the dummy columns
+        # aligned; categories unseen in training encode to all zeros
+        dummies = encoder.transform(dataset[string_feats])
+        dataset = dataset.drop(string_feats, axis=1)
+        dataset[list(encoder.get_feature_names_out(string_feats))] = dummies
 
-    # remove train dataset back again
-    dataset = dataset.drop(train_index).reset_index(drop=True)
+    # normalize data with a single vectorized divide over the value columns
+    if value_feats:
+        scales = np.array([float(norm_dict[f]) for f in value_feats], dtype=np.float32)
+        dataset[value_feats] = dataset[value_feats].to_numpy(dtype=np.float32) / scales
+
+    # store everything numeric as float32 so samples need no cast downstream
+    float_cols = dataset.select_dtypes(include='float64').columns
+    dataset[float_cols] = dataset[float_cols].astype(np.float32)
 
     # split into data w/ or w/o sequence data
     target_name = 'GAS_MONTH_1'
     feature_dataset = dataset[dataset[target_name].isna()]
-    sequence_dataset = dataset.dropna(subset=[target_name]).reset_index(drop=True)
+    sequence_dataset = dataset.dropna(subset=[target_name])
 
     total_features = [f for f in dataset.columns if ('MONTH' not in f and 'mo.' not in f)]
     exam_feature_dataset = WellDataset(feature_dataset, total_features, sequence=False, exam=True)
@@ -223,7 +333,6 @@ def augment_data(dataset):
 
     df = pd.DataFrame(data_list)
     dataset = pd.concat([dataset, df], axis=0, ignore_index=True)
-    dataset.reset_index(drop=True)
 
     return dataset
 
@@ -240,28 +349,52 @@ class WellDataset(Dataset):
     exam: bool (optional)
     """
     def __init__(self, dataset, features, gas_norm=1, sequence=False, exam=False):
-        self.dataset = dataset
         self.features = features
         self.gas_norm = gas_norm
         self.has_sequence = sequence
         self.exam = exam
 
+        # sequence columns covering the first 30 production months
+        self._mth = 31
+        self._gas_cols = [f'GAS_MONTH_{j}' for j in range(1, self._mth)]
+        self._cnd_cols = [f'CND_MONTH_{j}' for j in range(1, self._mth)]
+        self._hrs_cols = [f'HRS_MONTH_{j}' for j in range(1, self._mth)]
+
+        # materialize the per-sample columns as float32 matrices once,
+        # so __getitem__ only does positional NumPy indexing
+        self.gas_mat = dataset[self._gas_cols].to_numpy(dtype=np.float32)
+        self.cnd_mat = dataset[self._cnd_cols].to_numpy(dtype=np.float32)
+        self.hrs_mat = dataset[self._hrs_cols].to_numpy(dtype=np.float32)
+        self.feat_mat = dataset[features].to_numpy(dtype=np.float32)
+
+        # sequence length each sample will produce (leading zero vector
+        # plus one entry per active month), used for length bucketing
+        if sequence:
+            active = (self.hrs_mat != 0).sum(axis=1)
+            self.lengths = np.where(np.isnan(self.hrs_mat[:, 0]), 1, active + 1)
+        else:
+            self.lengths = np.ones(len(self.feat_mat), dtype=np.int64)
+
+        self.target_vec = None
+        if not exam:
+            target_name = 'Last 6 mo. Avg. GAS (Mcf)' if sequence else 'First 6 mo. Avg. GAS (Mcf)'
+            self.target_vec = dataset[target_name].to_numpy(dtype=np.float32) / gas_norm
+
     def __len__(self):
-        return len(self.dataset)
+        return len(self.feat_mat)
 
     def __getitem__(self, idx):
 
-        gas = np.array(self.dataset[[f'GAS_MONTH_{j}' for j in range(1, 31)]].loc[idx])
-        cnd = np.array(self.dataset[[f'CND_MONTH_{j}' for j in range(1, 31)]].loc[idx])
-        hrs = np.array(self.dataset[[f'HRS_MONTH_{j}' for j in range(1, 31)]].loc[idx])
+        if self.has_sequence:
+            sequences = seq_tensor(self.gas_mat[idx], self.cnd_mat[idx], self.hrs_mat[idx])
+        else:
+            sequences = torch.zeros(1, 4)
 
-        sequences = seq_tensor(gas, cnd, hrs) if self.has_sequence else torch.zeros(1, 4)
         target = torch.zeros(1)
         if not self.exam:
-            target_name = 'Last 6 mo. Avg. GAS (Mcf)' if self.has_sequence else 'First 6 mo. Avg. GAS (Mcf)'
-            target = torch.tensor(self.dataset[target_name].loc[idx]/self.gas_norm)
+            target = torch.as_tensor(self.target_vec[idx])
 
-        static_features = torch.tensor(self.dataset[self.features].loc[idx])
+        static_features = torch.from_numpy(self.feat_mat[idx])
         sample = {'features': static_features, 'sequences': sequences, 'target': target}
 
         return sample
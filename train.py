@@ -6,15 +6,109 @@ from torch.utils.data import DataLoader, random_split
 
 import os
 import pathlib
+import math
 import argparse
 import yaml
 
-from dataloader import seq_collate, preprocess, exam_loader
+from dataloader import seq_collate, preprocess, exam_loader, BucketBatchSampler
 from model import LSTMPredictor, FeatureMLP, KnapsackSolver
 from utilities import *
 
 
-def process(model, data_loader, optimizer=None, device='cpu'):
+def make_loader(dataset, batch_size, shuffle, collate_fn=None, batch_sampler=None):
+    """
+    Builds a torch.utils.data.DataLoader with the worker and memory
+    pinning options shared by the training and evaluation loops.
+    Parameters
+    ----------
+    dataset: torch.utils.data.Dataset
+    batch_size: int
+    shuffle: bool
+    collate_fn: callable (optional)
+    batch_sampler: (optional) iterable
+        yields batches of indices; batch_size and shuffle are ignored
+        when given.
+    Returns
+    -------
+    loader: torch.utils.data.DataLoader
+    """
+    global num_workers, pin_memory
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs['persistent_workers'] = True
+        worker_kwargs['prefetch_factor'] = 2
+
+    if batch_sampler is not None:
+        return DataLoader(dataset, batch_sampler=batch_sampler,
+                          collate_fn=collate_fn, num_workers=num_workers,
+                          pin_memory=pin_memory, **worker_kwargs)
+
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                      collate_fn=collate_fn, num_workers=num_workers,
+                      pin_memory=pin_memory, **worker_kwargs)
+
+
+class CudaPrefetcher:
+    """
+    Iterates over a DataLoader while copying the next batch to the GPU
+    on a side CUDA stream, so host-to-device transfers overlap with the
+    forward/backward pass of the current batch.
+    Parameters
+    ----------
+    data_loader: torch.utils.data.DataLoader
+    device: torch.device
+    """
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.data_loader)
+        self.preload()
+        return self
+
+    def __next__(self):
+        if self.next_samples is None:
+            raise StopIteration
+        current = torch.cuda.current_stream()
+        current.wait_stream(self.stream)
+        samples = self.next_samples
+
+        # tie each prefetched tensor to the consumer stream, so the
+        # allocator cannot recycle its memory for a later batch's copy
+        # while the current batch is still being read
+        for value in samples.values():
+            if isinstance(value, torch.Tensor):
+                value.record_stream(current)
+            else:  # PackedSequence
+                for field in (value.data, value.sorted_indices, value.unsorted_indices):
+                    if field is not None and field.is_cuda:
+                        field.record_stream(current)
+
+        self.preload()
+        return samples
+
+    def preload(self):
+        """
+        Fetches the next batch and issues its device copy on the side stream.
+        """
+        try:
+            samples = next(self.loader_iter)
+        except StopIteration:
+            self.next_samples = None
+            return
+
+        self.next_samples = dict(samples)
+        with torch.cuda.stream(self.stream):
+            for key in ('sequences', 'features', 'target'):
+                self.next_samples[key] = samples[key].to(self.device, non_blocking=True)
+
+
+def process(model, data_loader, optimizer=None, device='cpu', accum_steps=1):
     """
     Process samples. If an optimizer is given, also train on those samples.
     Parameters
@@ -26,36 +120,50 @@ def process(model, data_loader, optimizer=None, device='cpu'):
     optimizer: torch.optim (optional)
         Optimizer object. If not None, will be used for updating the model parameters.
     device: torch.device
+    accum_steps: int (optional)
+        number of batches to accumulate gradients over per optimizer step.
     Returns
     -------
     mean_loss : float
-        Mean MSE loss.
+        Root mean squared error over the dataset.
     """
-    total_loss = 0
+    total_loss = 0.0
     n_data = len(data_loader.dataset)
+    n_batches = len(data_loader)
 
     if optimizer is None:
         model.eval()
     else:
         model.train()
-
-    with torch.set_grad_enabled(optimizer is not None):
-        for _, samples in enumerate(data_loader):
-            sequences = samples['sequences'].to(device)
-            features = samples['features'].float().to(device)
-            label = samples['target'].float()
+        optimizer.zero_grad()
+
+    if device != 'cpu':
+        data_loader = CudaPrefetcher(data_loader, device)
+
+    # inference_mode also skips the version-counter bookkeeping that
+    # set_grad_enabled(False) still pays for
+    grad_ctx = torch.enable_grad() if optimizer is not None else torch.inference_mode()
+    with grad_ctx:
+        for i, samples in enumerate(data_loader):
+            sequences = samples['sequences'].to(device, non_blocking=True)
+            features = samples['features'].to(device, non_blocking=True)
+            label = samples['target'].to(device, non_blocking=True)
             data = (sequences, features)
 
-            prediction = model(data).view(-1).cpu() * 1e5
-            loss = F.mse_loss(prediction, label, reduction='sum')
-            total_loss += loss
+            # bf16 needs no gradient scaling; the loss stays in fp32
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=device != 'cpu'):
+                prediction = model(data).view(-1) * 1e5
+            loss = F.mse_loss(prediction.float(), label, reduction='sum')
+            total_loss += loss.detach()
 
             if optimizer is not None:
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                (loss / accum_steps).backward()
+                if (i + 1) % accum_steps == 0 or (i + 1) == n_batches:
+                    optimizer.step()
+                    optimizer.zero_grad()
 
-    return total_loss / n_data
+    # single device synchronization at the end of the epoch
+    return math.sqrt(float(total_loss) / n_data)
 
 
 def train(model, optimizer, scheduler, dataset, logfile=None, device='cpu'):
@@ -80,7 +188,7 @@ def train(model, optimizer, scheduler, dataset, logfile=None, device='cpu'):
     model.state_dict(): dict
     """
     # Printing model info and configure param file
-    global save_dir, batch_size, ratio
+    global save_dir, batch_size, ratio, accum_steps
     log(f"Model info: \n{model}", logfile, verbose=False)
     param_name = 'sequence' if dataset.has_sequence else 'feature'
     param_dir = pathlib.Path(os.path.join(save_dir, f"best_params_{param_name}.pkl"))
@@ -93,17 +201,21 @@ def train(model, optimizer, scheduler, dataset, logfile=None, device='cpu'):
     fn = seq_collate if model.__class__.__name__ == 'LSTMPredictor' else None
     bs_train = min(len(train_dataset), batch_size)
     bs_valid = min(len(valid_dataset), batch_size)
-    train_loader = DataLoader(train_dataset, batch_size=bs_train, shuffle=True, collate_fn=fn)
-    valid_loader = DataLoader(valid_dataset, batch_size=bs_valid, shuffle=True, collate_fn=fn)
+    # group the sequence batches by length so the packed batches stay dense
+    sampler = None
+    if dataset.has_sequence:
+        sampler = BucketBatchSampler(dataset.lengths[train_dataset.indices], bs_train)
+    train_loader = make_loader(train_dataset, bs_train, shuffle=True, collate_fn=fn, batch_sampler=sampler)
+    valid_loader = make_loader(valid_dataset, bs_valid, shuffle=True, collate_fn=fn)
 
     for epoch in range(scheduler.max_epoch):
 
-        train_loss = process(model, train_loader, optimizer=optimizer, device=device)
+        train_loss = process(model, train_loader, optimizer=optimizer, device=device, accum_steps=accum_steps)
         valid_loss = process(model, valid_loader, optimizer=None, device=device)
 
         log(f"EPOCH {epoch}...", logfile)
-        log(f"  Train loss: {train_loss.pow(0.5)}", logfile)
-        log(f"  Valid loss: {valid_loss.pow(0.5)}", logfile)
+        log(f"  Train loss: {train_loss}", logfile)
+        log(f"  Valid loss: {valid_loss}", logfile)
 
         scheduler.step(valid_loss)
         if scheduler.num_bad_epoch == 0:
@@ -115,7 +227,7 @@ def train(model, optimizer, scheduler, dataset, logfile=None, device='cpu'):
 
     model.load_state_dict(torch.load(param_dir))
     valid_loss = process(model, valid_loader, optimizer=None, device=device)
-    log(f"  BEST VALID LOSS: {valid_loss.pow(0.5)}", logfile)
+    log(f"  BEST VALID LOSS: {valid_loss}", logfile)
 
     return model.state_dict()
 
@@ -130,7 +242,7 @@ def evaluate(model, dataset, device='cpu'):
     device: torch.device
     Returns
     -------
-    predictions: list
+    predictions: numpy.ndarray
     """
     # Passing data to torch.utils.data.DataLoader, use seq_collate for LSTM models
     global save_dir
@@ -139,17 +251,24 @@ def evaluate(model, dataset, device='cpu'):
     model.load_state_dict(torch.load(param_dir))
 
     fn = seq_collate if model.__class__.__name__ == 'LSTMPredictor' else None
-    test_loader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=fn)
+    test_loader = make_loader(dataset, batch_size=1, shuffle=False, collate_fn=fn)
+
+    if device != 'cpu':
+        test_loader = CudaPrefetcher(test_loader, device)
 
-    predictions = []
-    with torch.set_grad_enabled(False):
+    predictions = np.empty(len(dataset), dtype=np.float32)
+    offset = 0
+    with torch.inference_mode():
         for _, samples in enumerate(test_loader):
-            sequences = samples['sequences'].to(device)
-            features = samples['features'].float().to(device)
+            sequences = samples['sequences'].to(device, non_blocking=True)
+            features = samples['features'].to(device, non_blocking=True)
             data = (sequences, features)
 
-            production = model(data).view(-1).cpu().detach().numpy()
-            predictions.extend(production * 1e5)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=device != 'cpu'):
+                production = model(data).view(-1)
+            production = production.float().cpu().detach().numpy()
+            predictions[offset:offset + len(production)] = production * 1e5
+            offset += len(production)
 
     return predictions
 
@@ -174,19 +293,24 @@ def generate_pred_dist(model, dataset, device='cpu', num_pass=500):
     model.load_state_dict(torch.load(param_dir))
 
     fn = seq_collate if model.__class__.__name__ == 'LSTMPredictor' else None
-    test_loader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=fn)
+    test_loader = make_loader(dataset, batch_size=1, shuffle=False, collate_fn=fn)
     enable_dropout(model)
 
+    if device != 'cpu':
+        test_loader = CudaPrefetcher(test_loader, device)
+
     distribution = []
-    with torch.set_grad_enabled(False):
+    with torch.inference_mode():
         for _ in range(num_pass):
             predictions = []
             for _, samples in enumerate(test_loader):
-                sequences = samples['sequences'].to(device)
-                features = samples['features'].float().to(device)
+                sequences = samples['sequences'].to(device, non_blocking=True)
+                features = samples['features'].to(device, non_blocking=True)
                 data = (sequences, features)
 
-                production = model(data).view(-1).cpu().detach().numpy()
+                with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=device != 'cpu'):
+                    production = model(data).view(-1)
+                production = production.float().cpu().detach().numpy()
                 predictions.extend(production * 1e5)
 
             distribution.append(predictions)
@@ -206,11 +330,31 @@ if __name__ == '__main__':
         help='CUDA GPU id (-1 for CPU).',
         type=int,
         default=-1)
+    parser.add_argument(
+        '-b', '--batch_size',
+        help='Training batch size.',
+        type=int,
+        default=500)
+    parser.add_argument(
+        '--accum_steps',
+        help='Number of batches to accumulate gradients over per optimizer step.',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '-j', '--num_workers',
+        help='Number of DataLoader worker processes.',
+        type=int,
+        default=4)
+    parser.add_argument(
+        '--no_pin_memory',
+        help='Disable pinned host memory for DataLoader batches.',
+        action='store_true')
     args = parser.parse_args()
 
     # Hyperparameters
     max_epoch = 1000
-    batch_size = 500
+    batch_size = args.batch_size
+    accum_steps = args.accum_steps
     ratio = 0.2
     lr = 1e-5
     patience = 50
@@ -236,6 +380,10 @@ if __name__ == '__main__':
         torch.cuda.set_device(device_num)
         device = torch.device('cuda')
 
+    # DataLoader setup, pinned memory only pays off on a CUDA device
+    num_workers = args.num_workers
+    pin_memory = (device != 'cpu') and not args.no_pin_memory
+
     # logging setup
     os.makedirs(save_dir, exist_ok=True)
     logfile = os.path.join(save_dir, 'train_log.txt')
@@ -245,6 +393,7 @@ if __name__ == '__main__':
     log(f"Debug mode: {args.debug}", logfile)
     log(f"Max epochs: {max_epoch}", logfile)
     log(f"Batch size: {batch_size}", logfile)
+    log(f"Accumulation steps: {accum_steps}", logfile)
     log(f"Learning rate: {lr}", logfile)
     log(f"Random noise: {noise}", logfile)
     log(f"Device: {device}")
@@ -257,7 +406,7 @@ if __name__ == '__main__':
 
     log(f"Initiating data augmentation...", logfile)
     train_file = pd.read_csv(train_root_path)
-    feature_dataset, sequence_dataset = preprocess(train_file, norm_dict, removes, augment=False)
+    feature_dataset, sequence_dataset, encoder = preprocess(train_file, norm_dict, removes, augment=False)
     log(f"Data loading completed. "
         f"{len(feature_dataset)} total feature data and "
         f"{len(sequence_dataset)} sequence data.", logfile)
@@ -282,22 +431,19 @@ if __name__ == '__main__':
 
     # Make predictions with the exam data
     test_file = pd.read_csv(test_root_path)
-    feature_test, sequence_test = exam_loader(train_file, test_file, norm_dict, removes)
+    feature_test, sequence_test = exam_loader(test_file, norm_dict, removes, encoder=encoder)
     log(f"Data loading completed. "
         f"{len(feature_test)} total feature exam data and "
         f"{len(sequence_test)} exam sequence data.", logfile)
 
-    model_feature = model_feature.cpu()
-    model_sequence = model_sequence.cpu()
-
     # Generates predictive distribution, and export to csv
     log("Making Predictions...")
-    feature_predictions = evaluate(model_feature, feature_test)
-    sequence_predictions = evaluate(model_sequence, sequence_test)
-    predictions = feature_predictions + sequence_predictions
+    feature_predictions = evaluate(model_feature, feature_test, device=device)
+    sequence_predictions = evaluate(model_sequence, sequence_test, device=device)
+    predictions = np.concatenate([feature_predictions, sequence_predictions])
 
-    feature_distribution = generate_pred_dist(model_feature, feature_test)
-    sequence_distribution = generate_pred_dist(model_sequence, sequence_test)
+    feature_distribution = generate_pred_dist(model_feature, feature_test, device=device)
+    sequence_distribution = generate_pred_dist(model_sequence, sequence_test, device=device)
     feature_distribution = pd.DataFrame(feature_distribution)
     sequence_distribution = pd.DataFrame(sequence_distribution)
 